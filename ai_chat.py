@@ -412,14 +412,14 @@ class OpenAIAssistant(LLMBase):
                 stream=True  # 启用流式传输
             )
 
-            # 用于累积完整的响应
-            full_response = ""
+            # 用于累积完整的响应片段，结束时一次性拼接
+            parts = []
             
             # 逐个产出流式响应
             for chunk in stream:
                 if chunk.choices[0].delta.content is not None:
                     content = chunk.choices[0].delta.content
-                    full_response += content
+                    parts.append(content)
                     yield {
                         "content": content,
                         "type": "content",
@@ -429,7 +429,7 @@ class OpenAIAssistant(LLMBase):
 
             # 保存完整的对话到上下文
             self.conversation_context[user_id].append(
-                {"role": "assistant", "content": full_response}
+                {"role": "assistant", "content": "".join(parts)}
             )
             
             # 保存对话历史
@@ -537,7 +537,7 @@ def print_help():
 
 def process_stream_response(response_stream):
     """处理流式响应"""
-    full_response = ""
+    parts = []  # 累积响应片段，结束时一次性拼接
     for response in response_stream:
         if "error" in response:
             print(f"\n错误: {response['error']}")
@@ -545,10 +545,10 @@ def process_stream_response(response_stream):
         
         if response["type"] == "content":
             print(response["content"], end="", flush=True)
-            full_response += response["content"]
+            parts.append(response["content"])
         elif response["type"] == "done":
             print()  # 换行
-            return full_response
+            return "".join(parts)
 
 def main(config_dir=None, data_dir=None):
     """主函数"""
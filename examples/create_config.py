@@ -36,11 +36,22 @@ def create_default_config(config_dir: str = None, data_dir: str = None) -> str:
         },
         "storage": {
             "conversations_path": os.path.join(rel_data_dir, 'conversations.json'),
-            "prompts_path": os.path.join(rel_data_dir, 'prompts.json')
+            "prompts_path": os.path.join(rel_data_dir, 'prompts.json'),
+            "semantic_cache_path": os.path.join(rel_data_dir, 'semantic_cache')
         },
         "conversation": {
             "max_turns": 10,
-            "truncate_mode": "sliding"
+            "truncate_mode": "sliding",
+            "max_users": 1000
+        },
+        "cache": {
+            "enabled": False,
+            "embedding_model": "text-embedding-3-small",
+            "similarity_threshold": 0.92,
+            "ttl": 86400,
+            "max_entries": 10000,
+            "prefetch": False,
+            "prefetch_threshold": 0.95
         }
     }
     
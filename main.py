@@ -5,41 +5,277 @@ Description:
 邮箱：wdsnpshy@163.com 
 Copyright (c) 2024 by ${wds-Ubuntu22-cqu}, All Rights Reserved. 
 '''
+import asyncio
+import io
+import logging
 import os
+import re
+import threading
 import time
 from openai_wds import create_assistant
+from openai_wds.assistants.openai_assistant import STREAM_CONTENT, STREAM_DONE
 from examples.create_config import create_default_config
 import sys
 
+_HELP_TEXT = "\n".join([
+    "\n=== 命令列表 ===",
+    "exit/quit: 退出程序",
+    "help: 显示帮助信息",
+    "clear: 清除当前对话历史",
+    "history: 显示历史对话",
+    "role: 显示当前角色",
+    "roles: 显示所有可用角色",
+    "role <type>: 切换角色 (例如: role professional)",
+    "context: 显示当前对话上下文信息",
+    "set_turns <number>: 设置最大对话轮数",
+    "set_truncate <mode>: 设置截断模式 (sliding/clear)",
+    "================\n\n",
+])
+
+_WELCOME_TEXT = "欢迎使用AI助手！输入'help'查看命令列表，输入'exit'或'quit'退出。\n"
+
+def _readline_input(prompt):
+    """非交互模式下的输入函数，直接从标准输入读取一行"""
+    sys.stdout.write(prompt)
+    sys.stdout.flush()
+    line = sys.stdin.readline()
+    if not line:
+        raise EOFError
+    return line.rstrip("\n")
+
+# 终端中使用input以保留行编辑功能，管道输入时直接读取标准输入
+_read_input = input if sys.stdin.isatty() else _readline_input
+
 def print_help():
     """打印帮助信息"""
-    print("\n=== 命令列表 ===")
-    print("exit/quit: 退出程序")
-    print("help: 显示帮助信息")
-    print("clear: 清除当前对话历史")
-    print("history: 显示历史对话")
-    print("role: 显示当前角色")
-    print("roles: 显示所有可用角色")
-    print("role <type>: 切换角色 (例如: role professional)")
-    print("context: 显示当前对话上下文信息")
-    print("set_turns <number>: 设置最大对话轮数")
-    print("set_truncate <mode>: 设置截断模式 (sliding/clear)")
-    print("================\n")
-
-def process_stream_response(response_stream):
-    """处理流式响应"""
-    full_response = ""
-    for response in response_stream:
-        if "error" in response:
-            print(f"\n错误: {response['error']}")
+    sys.stdout.write(_HELP_TEXT)
+
+# 遇到这些字符时立即刷新输出，保持逐字输出的观感
+_FLUSH_CHARS = frozenset(' \n,.!?，。！？')
+# 未遇到上述字符时，累计超过该字符数或时间间隔(秒)也会刷新
+_FLUSH_SIZE = 16
+_FLUSH_INTERVAL = 0.03
+
+class _StreamPrinter:
+    """
+    输出流式回复：直接写入stdout并按字符、长度或时间间隔批量刷新，
+    同时记录首个内容片段的到达时间并累积完整回复
+    """
+    __slots__ = ('_write', '_flush', '_parts', '_pending', '_last_flush', 't_first')
+
+    def __init__(self, t_start):
+        self._write = sys.stdout.write
+        self._flush = sys.stdout.flush
+        self._parts = []  # 累积响应片段，结束时一次性拼接
+        self._pending = 0  # 自上次刷新以来写入的字符数
+        self._last_flush = t_start
+        self.t_first = None
+
+    def feed(self, payload):
+        """输出一个内容片段"""
+        self._write(payload)
+        self._parts.append(payload)
+        self._pending += len(payload)
+        now = time.monotonic()
+        if self.t_first is None:
+            self.t_first = now
+        if (self._pending >= _FLUSH_SIZE or now - self._last_flush >= _FLUSH_INTERVAL
+                or not _FLUSH_CHARS.isdisjoint(payload)):
+            self._flush()
+            self._pending = 0
+            self._last_flush = now
+
+    def finish(self):
+        """回复完成，换行并返回(完整回复, 首个片段时间, 结束时间)"""
+        print()  # 换行并刷新剩余输出
+        return "".join(self._parts), self.t_first, time.monotonic()
+
+    def fail(self, error=None):
+        """回复出错或流意外结束，返回(None, 首个片段时间, 结束时间)"""
+        if error is not None:
+            print(f"\n错误: {error}")
+        return None, self.t_first, time.monotonic()
+
+def process_stream_response(response_stream, t_start):
+    """
+    处理流式响应
+    Args:
+        response_stream: chat_stream_raw返回的 (kind, payload) 响应流
+        t_start: 发起请求时的time.monotonic()时间
+    Returns:
+        (完整回复, 首个内容片段到达时间, 结束时间)，出错时完整回复为None，
+        未收到内容时首个片段时间为None
+    """
+    printer = _StreamPrinter(t_start)
+    for kind, payload in response_stream:
+        if kind == STREAM_CONTENT:
+            printer.feed(payload)
+        elif kind == STREAM_DONE:
+            return printer.finish()
+        else:
+            return printer.fail(payload)
+    return printer.fail()
+
+async def process_stream_response_async(response_stream, t_start):
+    """
+    处理异步流式响应，返回值与process_stream_response一致
+    Args:
+        response_stream: achat_stream_raw返回的 (kind, payload) 异步响应流
+        t_start: 发起请求时的time.monotonic()时间
+    """
+    printer = _StreamPrinter(t_start)
+    async for kind, payload in response_stream:
+        if kind == STREAM_CONTENT:
+            printer.feed(payload)
+        elif kind == STREAM_DONE:
+            return printer.finish()
+        else:
+            return printer.fail(payload)
+    return printer.fail()
+
+def _print_latency(t0, t_first, t_end):
+    """输出首字延迟(TTFT)与总延迟"""
+    if t_first is not None:
+        print(f"首字延迟: {(t_first - t0) * 1000:.0f}ms  回复延迟: {t_end - t0:.2f}秒")
+    else:
+        print(f"回复延迟: {t_end - t0:.2f}秒")
+
+async def _ainput(prompt):
+    """
+    在守护线程中读取一行输入，等待期间不阻塞事件循环
+    使用守护线程而不是默认线程池，退出时不会等待仍阻塞在读取上的线程
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def _resolve(result, error):
+        if future.done():
             return
-        
-        if response["type"] == "content":
-            print(response["content"], end="", flush=True)
-            full_response += response["content"]
-        elif response["type"] == "done":
-            print()  # 换行
-            return full_response
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _reader():
+        try:
+            line = _read_input(prompt)
+        except BaseException as e:
+            loop.call_soon_threadsafe(_resolve, None, e)
+        else:
+            loop.call_soon_threadsafe(_resolve, line, None)
+
+    threading.Thread(target=_reader, daemon=True).start()
+    return await future
+
+def _do_exit(assistant, user_id, arg):
+    """退出程序，返回True通知主循环结束"""
+    print("再见！")
+    return True
+
+def _do_help(assistant, user_id, arg):
+    """打印帮助信息"""
+    print_help()
+
+def _do_clear(assistant, user_id, arg):
+    """清除对话历史"""
+    assistant.clear_context(user_id)
+    print("对话历史已清除！")
+
+def _do_context(assistant, user_id, arg):
+    """显示当前对话信息"""
+    summary = assistant.get_context_summary(user_id)
+    fields = [
+        ("消息数量", summary['message_count']),
+        ("是否有上下文", '是' if summary['has_context'] else '否'),
+        ("当前角色", summary.get('current_role', 'default')),
+        ("当前对话轮数", f"{summary['current_turns']}/{summary['max_turns']}"),
+    ]
+    if summary['has_context']:
+        fields.append(("最后更新时间", summary['last_message_time']))
+    lines = ["\n=== 当前对话信息 ==="]
+    lines.extend(f"{key}: {value}" for key, value in fields)
+    lines.append("==================\n")
+    sys.stdout.write("\n".join(lines))
+
+def _do_role_show(assistant, user_id, arg):
+    """显示当前角色"""
+    print(f"当前角色: {assistant.get_current_role()}")
+
+def _do_roles(assistant, user_id, arg):
+    """显示所有可用角色"""
+    roles = assistant.list_available_roles()
+    print("\n可用角色:")
+    for role in roles:
+        print(f"- {role}")
+
+def _do_history(assistant, user_id, arg):
+    """显示历史对话"""
+    buf = io.StringIO()
+    buf.write("\n=== 历史对话 ===\n")
+    for conv in assistant.get_conversation_history(user_id):
+        buf.write(f"\n时间: {conv['timestamp']}\n")
+        for msg in conv['messages']:
+            if msg['role'] != 'system':
+                prefix = "AI: " if msg['role'] == 'assistant' else "您: "
+                buf.write(f"{prefix}{msg['content']}\n")
+    buf.write("\n==============\n")
+    sys.stdout.write(buf.getvalue())
+
+def _do_role_set(assistant, user_id, arg):
+    """切换角色"""
+    if assistant.set_role(arg):
+        print(f"已切换到角色: {arg}")
+    else:
+        print(f"切换角色失败: {arg} 不是有效的角色类型")
+
+def _do_set_turns(assistant, user_id, arg):
+    """设置最大对话轮数"""
+    try:
+        turns = int(arg)
+    except ValueError:
+        print("请输入有效的数字")
+        return
+    if turns < 1:
+        print("对话轮数必须大于0")
+        return
+    try:
+        assistant.update_settings({"max_turns": turns})
+    except (ValueError, OverflowError) as e:
+        print(f"设置失败: {e}")
+        return
+    print(f"已设置最大对话轮数为: {turns}")
+
+def _do_set_truncate(assistant, user_id, arg):
+    """设置截断模式"""
+    if arg not in ['sliding', 'clear']:
+        print("无效的截断模式，请使用 'sliding' 或 'clear'")
+    else:
+        assistant.update_settings({"truncate_mode": arg})
+        print(f"已设置截断模式为: {arg}")
+
+# 完整命令的最大长度，更长的输入直接作为对话内容
+_MAX_COMMAND_LEN = 16
+
+# 完整匹配的命令(不区分大小写)，处理函数返回True时主循环结束
+COMMANDS = {
+    "exit": _do_exit,
+    "quit": _do_exit,
+    "help": _do_help,
+    "clear": _do_clear,
+    "context": _do_context,
+    "role": _do_role_show,
+    "roles": _do_roles,
+    "history": _do_history,
+}
+
+# 带参数的命令，格式为 "<命令> <参数>"
+PREFIX_COMMANDS = {
+    "role": _do_role_set,
+    "set_turns": _do_set_turns,
+    "set_truncate": _do_set_truncate,
+}
+
+_PREFIX_RE = re.compile(r'^(role|set_turns|set_truncate)\s+(\S.*)$', re.IGNORECASE)
 
 def setup_environment():
     """设置环境"""
@@ -53,7 +289,33 @@ def setup_environment():
     
     return config_path
 
-def main():
+def _find_command(user_input):
+    """
+    查找输入对应的命令处理函数
+    带参数的命令由正则一次匹配出命令与参数，完整命令只对短输入做小写转换，长文本不会被整体转换
+    Returns:
+        (处理函数, 参数)，不是命令时处理函数为None
+    """
+    match = _PREFIX_RE.match(user_input)
+    if match:
+        return PREFIX_COMMANDS[match.group(1).lower()], match.group(2)
+    if len(user_input) <= _MAX_COMMAND_LEN:
+        return COMMANDS.get(user_input.lower()), ""
+    return None, ""
+
+def _run_command(handler, assistant, user_id, arg):
+    """执行命令处理函数，命令出错时只输出错误信息，不会结束交互循环"""
+    try:
+        return handler(assistant, user_id, arg)
+    except Exception as e:
+        print(f"\n命令执行失败: {str(e)}")
+        return False
+
+def _start_session():
+    """创建助手并输出欢迎信息，返回(助手, 用户ID)"""
+    # 助手内部的错误通过logging输出到stderr
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    
     # 设置环境并获取配置文件路径
     config_path = setup_environment()
     
@@ -61,105 +323,93 @@ def main():
     assistant = create_assistant(config_path)
     user_id = "test_user"
     
-    print("欢迎使用AI助手！输入'help'查看命令列表，输入'exit'或'quit'退出。")
-    print(f"当前角色: {assistant.get_current_role()}")
-    print_help()
+    sys.stdout.write(f"{_WELCOME_TEXT}当前角色: {assistant.get_current_role()}\n{_HELP_TEXT}")
     
-    # 设置默认角色
-    assistant.set_role("儿童心理专家")
-    print(f"已切换到角色: {assistant.get_current_role()}")
+    # 设置默认角色，切换成功时角色名即为当前角色，无需再次查询
+    default_role = "儿童心理专家"
+    current_role = default_role if assistant.set_role(default_role) else assistant.get_current_role()
+    print(f"已切换到角色: {current_role}")
+    return assistant, user_id
+
+def main():
+    assistant, user_id = _start_session()
     
+    # 延迟统计使用单调时钟，不受系统时间调整影响
+    _now = time.monotonic
     while True:
         try:
-            user_input = input("\n您: ").strip()
-            
-            # 处理特殊命令
-            if user_input.lower() in ['exit', 'quit']:  # 退出程序
-                print("再见！")
-                sys.exit(0)
-            elif user_input.lower() == 'help':  # 打印帮助信息
-                print_help()
-                continue
-            elif user_input.lower() == 'clear':  # 清除对话历史
-                assistant.clear_context(user_id)
-                print("对话历史已清除！")
-                continue
-            elif user_input.lower() == 'context':  # 显示当前对话信息
-                summary = assistant.get_context_summary(user_id)
-                print("\n=== 当前对话信息 ===")
-                print(f"消息数量: {summary['message_count']}")
-                print(f"是否有上下文: {'是' if summary['has_context'] else '否'}")
-                print(f"当前角色: {summary.get('current_role', 'default')}")
-                print(f"当前对话轮数: {summary['current_turns']}/{summary['max_turns']}")
-                if summary['has_context']:
-                    print(f"最后更新时间: {summary['last_message_time']}")
-                print("==================")
-                continue
-            elif user_input.lower() == 'role':  # 显示当前角色
-                print(f"当前角色: {assistant.get_current_role()}")
-                continue
-            elif user_input.lower() == 'roles':  # 显示所有可用角色
-                roles = assistant.list_available_roles()
-                print("\n可用角色:")
-                for role in roles:
-                    print(f"- {role}")
-                continue
-            elif user_input.lower().startswith('role '):  # 切换角色
-                new_role = user_input.split(' ')[1].strip()
-                if assistant.set_role(new_role):
-                    print(f"已切换到角色: {new_role}")
-                else:
-                    print(f"切换角色失败: {new_role} 不是有效的角色类型")
-                continue
-            elif user_input.lower() == 'history':  # 显示历史对话
-                history = assistant.get_conversation_history(user_id)
-                print("\n=== 历史对话 ===")
-                for conv in history:
-                    print(f"\n时间: {conv['timestamp']}")
-                    for msg in conv['messages']:
-                        if msg['role'] != 'system':
-                            prefix = "AI: " if msg['role'] == 'assistant' else "您: "
-                            print(f"{prefix}{msg['content']}")
-                print("\n==============")
-                continue
-            elif user_input.lower().startswith('set_turns '):  # 设置最大对话轮数
-                try:
-                    turns = int(user_input.split(' ')[1])
-                    if turns < 1:
-                        print("对话轮数必须大于0")
-                    else:
-                        assistant.update_settings({"max_turns": turns})
-                        print(f"已设置最大对话轮数为: {turns}")
-                except ValueError:
-                    print("请输入有效的数字")
-                continue
-            elif user_input.lower().startswith('set_truncate '):  # 设置截断模式
-                mode = user_input.split(' ')[1].strip()
-                if mode not in ['sliding', 'clear']:
-                    print("无效的截断模式，请使用 'sliding' 或 'clear'")
-                else:
-                    assistant.update_settings({"truncate_mode": mode})
-                    print(f"已设置截断模式为: {mode}")
-                continue
-            elif not user_input:  # 如果用户输入为空，则跳过 
-                continue
-            
-            time_now = time.time()
-            
-            # 使用流式接口
-            print("\nAI: ", end="", flush=True)
-            response_stream = assistant.chat_stream(user_id, user_input)
-            process_stream_response(response_stream)
-            
-            # 输出回复的延迟
-            print(f"回复延迟: {time.time() - time_now:.2f}秒")
-                
+            user_input = _read_input("\n您: ").strip()
+        except (KeyboardInterrupt, EOFError):
+            print("\n\n程序被中断。再见！")
+            return
+        
+        # 处理特殊命令
+        handler, arg = _find_command(user_input)
+        if handler is not None:
+            if _run_command(handler, assistant, user_id, arg):
+                return
+            continue
+        if not user_input:  # 如果用户输入为空，则跳过 
+            continue
+        
+        t0 = _now()
+        
+        # 使用流式接口
+        print("\nAI: ", end="", flush=True)
+        try:
+            response_stream = assistant.chat_stream_raw(user_id, user_input)
+            _, t_first, t_end = process_stream_response(response_stream, t0)
         except KeyboardInterrupt:
             print("\n\n程序被中断。再见！")
-            sys.exit(0)
+            return
+        except Exception as e:
+            print(f"\n发生错误: {str(e)}")
+            print("请重试...")
+            continue
+        
+        _print_latency(t0, t_first, t_end)
+
+async def async_main():
+    """基于异步客户端的交互循环，等待输入和接收回复时不阻塞事件循环"""
+    assistant, user_id = _start_session()
+    
+    _now = time.monotonic
+    while True:
+        try:
+            user_input = (await _ainput("\n您: ")).strip()
+        except EOFError:
+            print("\n\n程序被中断。再见！")
+            return
+        
+        # 处理特殊命令
+        handler, arg = _find_command(user_input)
+        if handler is not None:
+            if _run_command(handler, assistant, user_id, arg):
+                return
+            continue
+        if not user_input:  # 如果用户输入为空，则跳过 
+            continue
+        
+        t0 = _now()
+        
+        # 使用异步流式接口
+        print("\nAI: ", end="", flush=True)
+        try:
+            response_stream = assistant.achat_stream_raw(user_id, user_input)
+            _, t_first, t_end = await process_stream_response_async(response_stream, t0)
         except Exception as e:
             print(f"\n发生错误: {str(e)}")
             print("请重试...")
+            continue
+        
+        _print_latency(t0, t_first, t_end)
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    # 使用 --async 参数时运行基于异步客户端的交互循环
+    if "--async" in sys.argv[1:]:
+        try:
+            asyncio.run(async_main())
+        except KeyboardInterrupt:
+            print("\n\n程序被中断。再见！")
+    else:
+        main()
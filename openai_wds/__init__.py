@@ -5,14 +5,30 @@ OpenAI Assistant
 A flexible OpenAI API wrapper with multi-role support and context management.
 """
 
+import functools
 import os
-from .assistants.openai_assistant import OpenAIAssistant
+from importlib.resources import files
 
 __version__ = '0.1.0'
 
 # 获取包的默认配置目录
 DEFAULT_CONFIG_DIR = os.path.join(os.path.dirname(__file__), 'config')
 DEFAULT_DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+# 默认配置文件路径，导入时解析一次
+_DEFAULT_CONFIG_PATH = str(files(__name__) / 'config' / 'config.json')
+
+def _load_env():
+    """导入包时加载一次.env文件，环境变量中已有API密钥时无需解析"""
+    if os.getenv('OPENAI_API_KEY') is None:
+        from dotenv import load_dotenv
+        load_dotenv()
+
+_load_env()
+
+def reload_env():
+    """重新加载.env文件，覆盖已存在的同名环境变量"""
+    from dotenv import load_dotenv
+    load_dotenv(override=True)
 
 # 提供便捷的工厂函数
 def create_assistant(config_path=None):
@@ -25,9 +41,35 @@ def create_assistant(config_path=None):
     Returns:
         OpenAIAssistant实例
     """
-    if config_path is None:
-        config_path = os.path.join(DEFAULT_CONFIG_DIR, 'config.json')
-    return OpenAIAssistant(config_path)
+    from .assistants.openai_assistant import OpenAIAssistant
+    return OpenAIAssistant(config_path or _DEFAULT_CONFIG_PATH)
+
+@functools.lru_cache(maxsize=None)
+def _get_assistant(config_path):
+    """按配置文件路径缓存的助手实例"""
+    return create_assistant(config_path)
+
+def get_assistant(config_path=None):
+    """
+    获取进程内共享的OpenAI助手实例，相同配置路径返回同一个实例
+    适合在同一进程内多处使用助手的场景；各调用方共享角色与对话上下文，
+    需要相互独立的实例时请使用create_assistant
+    
+    Args:
+        config_path: 可选的配置文件路径，如果不提供则使用默认配置
+    
+    Returns:
+        OpenAIAssistant实例
+    """
+    return _get_assistant(config_path or _DEFAULT_CONFIG_PATH)
+
+def __getattr__(name):
+    """延迟导入OpenAIAssistant，仅使用包内常量时无需加载助手模块及其依赖"""
+    if name == 'OpenAIAssistant':
+        from .assistants.openai_assistant import OpenAIAssistant
+        globals()['OpenAIAssistant'] = OpenAIAssistant
+        return OpenAIAssistant
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # 导出主要的类和函数
-__all__ = ['OpenAIAssistant', 'create_assistant'] 
\ No newline at end of file
+__all__ = ['OpenAIAssistant', 'create_assistant', 'get_assistant', 'reload_env'] 
\ No newline at end of file
@@ -1,15 +1,123 @@
-import json
+import functools
+import hashlib
+import importlib.util
+import logging
 import os
 import time
-from typing import Dict, Any, List, Optional
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Any, List, Optional, Tuple
 from datetime import datetime
-from dotenv import load_dotenv
-from openai import OpenAI
-from tenacity import retry, stop_after_attempt, wait_exponential
-from ..base.llm_base import LLMBase
+from urllib.parse import quote
 from ..utils.config_loader import ConfigLoader
+from ..utils.json_utils import (
+    json_loads, json_dumps, dump_json_atomic, write_bytes_atomic, JSONDecodeError
+)
+from ..utils.semantic_cache import SemanticCache
+from ..utils.history_writer import get_history_writer
+
+try:
+    import fcntl  # 仅POSIX系统可用，用于多进程写入对话历史时加锁
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# max_turns的上限，历史deque的maxlen约为其两倍
+_MAX_TURNS_LIMIT = 10000
+
+# 编码后的用户ID作为文件名的最大长度，超过时改用摘要，避免超出文件系统的文件名长度限制
+_MAX_FILENAME_ID_LEN = 200
+
+# 每条消息在对话格式中的额外token开销，以及为估算误差预留的token数
+_TOKENS_PER_MESSAGE = 4
+_TOKEN_SAFETY_MARGIN = 64
+
+# 流式输出的批量产出条件：距上次产出超过该秒数，或累积片段数达到上限
+_STREAM_FLUSH_INTERVAL = 0.02
+_STREAM_FLUSH_CHUNKS = 16
+
+# chat_stream_raw产出的 (kind, payload) 元组的类型标识
+STREAM_CONTENT = 0  # payload为文本片段
+STREAM_DONE = 1     # payload为完整回复
+STREAM_ERROR = 2    # payload为错误信息
+
+# 进程内共享的同步HTTP客户端，按连接配置区分，多个助手实例复用同一连接池
+_HTTP_CLIENTS: Dict[Tuple, Any] = {}
+
+
+def _http_timeout(openai_config: Dict[str, Any]):
+    """分阶段超时：连接、写入和等待连接池各5秒，读取使用配置中的timeout"""
+    import httpx
+    return httpx.Timeout(connect=5, read=openai_config.get('timeout', 30), write=5, pool=5)
+
+
+def _http_client_options(openai_config: Dict[str, Any]) -> Dict[str, Any]:
+    """根据openai配置构造httpx客户端参数：keep-alive连接池、分阶段超时，安装h2时启用HTTP/2"""
+    import httpx
+    return dict(
+        http2=openai_config.get('http2', True) and importlib.util.find_spec('h2') is not None,
+        limits=httpx.Limits(
+            max_keepalive_connections=openai_config.get('max_keepalive_connections', 64),
+            max_connections=openai_config.get('max_connections', 128)
+        ),
+        timeout=_http_timeout(openai_config)
+    )
+
+
+def _get_shared_http_client(openai_config: Dict[str, Any]):
+    """获取(必要时创建)共享的同步HTTP客户端"""
+    import httpx
+    key = (
+        openai_config.get('http2', True),
+        openai_config.get('max_keepalive_connections', 64),
+        openai_config.get('max_connections', 128),
+        openai_config.get('timeout', 30)
+    )
+    client = _HTTP_CLIENTS.get(key)
+    if client is None or client.is_closed:
+        client = httpx.Client(**_http_client_options(openai_config))
+        _HTTP_CLIENTS[key] = client
+    return client
+
+class _ChunkBatcher:
+    """
+    合并流式输出的片段：距上次产出超过_STREAM_FLUSH_INTERVAL秒或累积_STREAM_FLUSH_CHUNKS个片段时产出一次，
+    同时累积完整回复，结束时一次性拼接
+    """
+    __slots__ = ('_parts', '_pending', '_last_flush')
+
+    def __init__(self):
+        self._parts: List[str] = []
+        self._pending: List[str] = []
+        self._last_flush = time.perf_counter()
+
+    def feed(self, content: str) -> Optional[str]:
+        """加入一个片段，达到产出条件时返回合并后的文本"""
+        self._parts.append(content)
+        self._pending.append(content)
+        now = time.perf_counter()
+        if now - self._last_flush >= _STREAM_FLUSH_INTERVAL or len(self._pending) >= _STREAM_FLUSH_CHUNKS:
+            self._last_flush = now
+            return self._take()
+        return None
+
+    def drain(self) -> Optional[str]:
+        """返回尚未产出的文本，没有时返回None"""
+        return self._take() if self._pending else None
+
+    def _take(self) -> str:
+        batch = "".join(self._pending)
+        self._pending.clear()
+        return batch
+
+    def text(self) -> str:
+        """完整回复"""
+        return "".join(self._parts)
+
+
+class OpenAIAssistant:
+    """基于OpenAI API的助手实现，满足 LLMBase 接口协议"""
 
-class OpenAIAssistant(LLMBase):
     def __init__(self, config_path: str):
         """
         初始化OpenAI Assistant实例
@@ -19,40 +127,185 @@ class OpenAIAssistant(LLMBase):
         self.config_loader = ConfigLoader(config_path)
         self.config = self.config_loader.get_config()
         self.client = None
+        self.aclient = None
+        # 对话历史由后台线程写入，保存时不阻塞回复
+        self._history_writer = get_history_writer()
         self.current_role = "default"
-        self.conversation_context = {}
+        # 按最近使用顺序保存用户上下文 (system消息, 历史消息deque)，超过max_users时淘汰最久未使用的用户
+        self.conversation_context: "OrderedDict[str, Tuple[Dict[str, str], Deque[Dict]]]" = OrderedDict()
         self.max_turns = self.config.get('conversation', {}).get('max_turns', 10)
         self.truncate_mode = self.config.get('conversation', {}).get('truncate_mode', 'sliding')
+        self.max_users = self.config.get('conversation', {}).get('max_users', 1000)
+        # 上下文token预算，为None时只按轮数截断
+        self.max_context_tokens = self.config.get('conversation', {}).get('max_context_tokens')
+        self._token_counter = None
+        # 每个用户最后一轮对话完成的时间(time.time())，仅在摘要输出时格式化
+        self._last_message_times: Dict[str, float] = {}
+        # 提示词缓存：仅在文件mtime变化时重新加载，避免每轮对话读盘
+        self._prompts: Dict[str, str] = {}
+        self._prompts_mtime: Optional[float] = None
+        # 最近一次读取失败时提示词文件的mtime，用于避免重复输出警告
+        self._prompts_failed_mtime: Optional[float] = None
+        # 每个角色对应的规范system消息，保证请求前缀逐字节稳定以命中服务端prompt缓存
+        self._system_messages: Dict[str, Dict[str, str]] = {}
+        self._ensure_prompts_file()
+        # 通过_refresh_prompts加载，提示词文件损坏时记录警告并使用空缓存，不影响初始化
+        self._refresh_prompts()
+        self.semantic_cache: Optional[SemanticCache] = None
+        # 预取槽：user_id -> (预取时的部分输入, 预取到的回复)
+        self._prefetched: Dict[str, Tuple[str, str]] = {}
+        self._migrate_legacy_conversations()
         self.initialize()
+        self._init_semantic_cache()
         
     def initialize(self) -> None:
-        """初始化OpenAI客户端"""
-        self.client = OpenAI(
-            api_key=self.config['openai']['api_key'],
-            base_url=self.config['openai'].get('base_url', "https://api.chatanywhere.tech"),
-            timeout=self.config['openai'].get('timeout', 30),  # 添加超时设置
+        """初始化OpenAI客户端(同步与异步)，使用调优过的连接池以复用TLS连接"""
+        # openai/httpx导入开销较大，延迟到真正需要客户端时再导入
+        import httpx
+        from openai import AsyncOpenAI, OpenAI
+        
+        openai_config = self.config['openai']
+        client_kwargs = dict(
+            api_key=openai_config['api_key'],
+            base_url=openai_config.get('base_url', "https://api.chatanywhere.tech"),
+            # SDK会在每个请求上覆盖http_client的超时，因此传入同样的分阶段超时
+            timeout=_http_timeout(openai_config),
+            # 重试交给SDK：只重试连接错误、超时、429和5xx，流式请求同样适用
+            max_retries=openai_config.get('max_retries', 2),
+        )
+        self.client = OpenAI(http_client=_get_shared_http_client(openai_config), **client_kwargs)
+        # 异步客户端与事件循环绑定，不跨实例共享
+        self.aclient = AsyncOpenAI(
+            http_client=httpx.AsyncClient(**_http_client_options(openai_config)), **client_kwargs
+        )
+        self._build_request_kwargs()
+
+    def _build_request_kwargs(self) -> None:
+        """根据配置预先构造请求参数，配置更新时重新构造"""
+        openai_config = self.config['openai']
+        self._request_kwargs = dict(
+            model=openai_config['model'],
+            temperature=openai_config.get('temperature', 0.7),
+            max_tokens=openai_config.get('max_tokens', 1000),
+            top_p=openai_config.get('top_p', 1.0)
         )
     
-    @retry(         # 重试机制，使用装饰器retry
-        stop=stop_after_attempt(3),  # 最多重试3次
-        wait=wait_exponential(multiplier=1, min=4, max=10),  # 指数退避重试
-        reraise=True
-    )
+    def _init_semantic_cache(self) -> None:
+        """根据配置初始化语义缓存(可选功能，需要numpy)"""
+        cache_config = self.config.get('cache', {})
+        if not cache_config.get('enabled', False):
+            return
+        self.semantic_cache = SemanticCache(
+            path=self.config['storage'].get('semantic_cache_path'),
+            similarity_threshold=cache_config.get('similarity_threshold', 0.92),
+            ttl=cache_config.get('ttl'),
+            max_entries=cache_config.get('max_entries', 10000)
+        )
+
+    def _embed(self, text: str) -> Optional[List[float]]:
+        """计算文本的embedding，失败时返回None"""
+        try:
+            response = self.client.embeddings.create(
+                model=self.config.get('cache', {}).get('embedding_model', 'text-embedding-3-small'),
+                input=text
+            )
+            return response.data[0].embedding
+        except Exception as e:
+            logger.warning("Embedding request failed: %s", e, exc_info=True)
+            return None
+
+    def prefetch(self, user_id: str, partial: str) -> Optional[str]:
+        """
+        在用户输入过程中用部分输入预先查询语义缓存
+        相似度超过更高的prefetch_threshold时将回复放入预取槽，
+        之后最终消息与该部分输入相同(末尾只多出标点)的chat调用会直接使用预取的回复
+        需要在配置中同时开启cache.enabled与cache.prefetch
+        Args:
+            user_id: 用户ID
+            partial: 用户尚未输入完成的消息
+        Returns:
+            预取到的回复，未命中时返回None
+        """
+        cache_config = self.config.get('cache', {})
+        if self.semantic_cache is None or not cache_config.get('prefetch', False):
+            return None
+        partial = partial.strip()
+        if not partial:
+            return None
+        
+        context = self.conversation_context.get(user_id)
+        history = context[1] if context is not None else []
+        embedding = self._embed(self._cache_query_text(history, partial))
+        if embedding is None:
+            return None
+        response = self.semantic_cache.lookup(
+            embedding, self.current_role,
+            threshold=cache_config.get('prefetch_threshold', 0.95)
+        )
+        if response is not None:
+            self._prefetched[user_id] = (partial, response)
+        return response
+
+    def _take_prefetched(self, user_id: str, message: str) -> Optional[str]:
+        """
+        取出预取槽中的回复
+        仅当最终消息与预取时的部分输入相同(忽略空白，末尾只多出标点也视为相同)时有效；
+        否则预取的回复不能代表完整问题，调用方会用完整消息重新查询语义缓存
+        """
+        slot = self._prefetched.pop(user_id, None)
+        if slot is None:
+            return None
+        partial, response = slot
+        message = " ".join(message.split())
+        partial = " ".join(partial.split())
+        if not message.startswith(partial):
+            return None
+        rest = message[len(partial):]
+        return response if not any(ch.isalnum() for ch in rest) else None
+
+    def _cache_query_text(self, context: List[Dict], message: str) -> str:
+        """由最近一条助手回复和用户消息构造语义缓存的查询文本"""
+        recent = ""
+        for msg in reversed(context):
+            if msg["role"] == "assistant":
+                recent = " ".join(msg["content"].split())
+                break
+        return f"{recent}\n{' '.join(message.split())}"
+
     def _make_request(self, messages: List[Dict]) -> Dict:
-        """发送请求到OpenAI API，带有重试机制"""
+        """发送请求到OpenAI API，临时性错误由SDK重试"""
         try:
             response = self.client.chat.completions.create(
-                model=self.config['openai']['model'],
-                messages=messages,
-                temperature=self.config['openai'].get('temperature', 0.7),
-                max_tokens=self.config['openai'].get('max_tokens', 1000),
-                top_p=self.config['openai'].get('top_p', 1.0)
+                messages=messages, **self._request_kwargs
+            )
+            return {"success": True, "data": response}
+        except Exception as e:
+            logger.exception("API request failed")
+            return {"success": False, "error": str(e)}
+
+    async def _amake_request(self, messages: List[Dict]) -> Dict:
+        """异步发送请求到OpenAI API，临时性错误由SDK重试"""
+        try:
+            response = await self.aclient.chat.completions.create(
+                messages=messages, **self._request_kwargs
             )
             return {"success": True, "data": response}
         except Exception as e:
-            print(f"API request failed: {str(e)}")
+            logger.exception("API request failed")
             return {"success": False, "error": str(e)}
 
+    async def _aembed(self, text: str) -> Optional[List[float]]:
+        """异步计算文本的embedding，失败时返回None"""
+        try:
+            response = await self.aclient.embeddings.create(
+                model=self.config.get('cache', {}).get('embedding_model', 'text-embedding-3-small'),
+                input=text
+            )
+            return response.data[0].embedding
+        except Exception as e:
+            logger.warning("Embedding request failed: %s", e, exc_info=True)
+            return None
+
     '''
     description: 处理用户消息
     param {*} self
@@ -70,152 +323,239 @@ class OpenAIAssistant(LLMBase):
             role_type: 指定的角色类型，如果为None则使用当前角色
         """
         try:
-            # 如果指定了新的角色类型，就更新当前角色
-            if role_type and role_type != self.current_role:
-                if not self.set_role(role_type):
-                    return {
-                        "error": f"无效的角色类型: {role_type}",
-                        "timestamp": datetime.now().isoformat()
-                    }
-
-            # 获取当前角色的提示词
-            system_prompt = self.load_prompt(self.current_role)
-            
-            # 获取或初始化用户的上下文
-            if user_id not in self.conversation_context:
-                self.conversation_context[user_id] = [{"role": "system", "content": system_prompt}]
-            else:
-                # 更新system message如果角色改变了
-                if self.conversation_context[user_id][0]["role"] == "system":
-                    self.conversation_context[user_id][0]["content"] = system_prompt
-                else:
-                    self.conversation_context[user_id].insert(0, {"role": "system", "content": system_prompt})
-            
-            # 在添加新消息前检查并截断上下文
-            if user_id in self.conversation_context:
-                self.conversation_context[user_id] = self._truncate_context(
-                    self.conversation_context[user_id]
-                )
-            
-            # 添加用户消息
-            self.conversation_context[user_id].append({"role": "user", "content": message})
+            error = self._check_role(role_type)
+            if error is not None:
+                return self._error_result(error)
+
+            messages, history = self._prepare_context(user_id, message)
             
-            # 使用重试机制发送请求
-            response = self._make_request(self.conversation_context[user_id])
+            # 优先使用输入过程中预取的回复，其次查询语义缓存，命中时无需请求API
+            reply, query = self._begin_cache_lookup(user_id, message, history)
+            embedding = None
+            if query is not None:
+                embedding = self._embed(query)
+                reply = self._lookup_cached(embedding)
+            if reply is not None:
+                self._record_turn(user_id, history, messages[-1], reply)
+                return self._chat_result(reply)
             
+            # 发送请求(临时性错误由SDK重试)
+            response = self._make_request(messages)
             if not response["success"]:
-                return {
-                    "error": response["error"],
-                    "timestamp": datetime.now().isoformat()
-                }
+                return self._error_result(response["error"])
             
-            assistant_message = response["data"].choices[0].message.content
-            self.conversation_context[user_id].append({"role": "assistant", "content": assistant_message})
-            
-            # 保存对话历史
-            self.save_conversation(user_id, self.conversation_context[user_id])
-            
-            return {
-                "response": assistant_message,
-                "timestamp": datetime.now().isoformat(),
-                "current_role": self.current_role
-            }
+            reply = response["data"].choices[0].message.content
+            self._record_turn(user_id, history, messages[-1], reply, embedding)
+            return self._chat_result(reply)
             
         except Exception as e:
-            print(f"Chat error: {str(e)}")
-            return {
-                "error": str(e),
-                "timestamp": datetime.now().isoformat(),
-                "current_role": self.current_role
-            }
+            logger.exception("Chat error")
+            return self._error_result(str(e))
     
-    def _load_prompts(self) -> Dict[str, str]:
-        """加载提示词模板"""
+    def _ensure_prompts_file(self) -> None:
+        """提示词文件不存在时创建默认文件，仅在初始化时调用一次"""
         prompts_path = self.config['storage']['prompts_path']
+        if os.path.exists(prompts_path):
+            return
+        logger.warning("未找到提示词文件 %s，创建默认文件", prompts_path)
+        os.makedirs(os.path.dirname(prompts_path), exist_ok=True)
+        default_prompts = {
+            "default": "You are a helpful assistant.",
+            "professional": "You are a professional assistant with expertise in various fields.",
+            "creative": "You are a creative assistant that helps with brainstorming.",
+            "code": "You are a coding assistant that helps with programming.",
+            "儿童心理专家": "你是一个儿童心理专家，擅长儿童心理健康和发展指导。",
+            "知心大姐姐": "你是一个知心大姐姐，擅长心理疗愈和心理疏导。"
+        }
+        dump_json_atomic(prompts_path, default_prompts, indent=True)
+
+    def _load_prompts(self) -> Dict[str, str]:
+        """加载提示词模板(只读，不会创建文件)"""
+        with open(self.config['storage']['prompts_path'], 'rb') as f:
+            return json_loads(f.read())
+
+    def _get_prompts_mtime(self) -> Optional[float]:
+        """获取提示词文件的修改时间，文件不存在时返回None"""
         try:
-            with open(prompts_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except FileNotFoundError:
-            print(f"警告: 未找到提示词文件 {prompts_path}，创建默认文件")
-            os.makedirs(os.path.dirname(prompts_path), exist_ok=True)
-            default_prompts = {
-                "default": "You are a helpful assistant.",
-                "professional": "You are a professional assistant with expertise in various fields.",
-                "creative": "You are a creative assistant that helps with brainstorming.",
-                "code": "You are a coding assistant that helps with programming.",
-                "儿童心理专家": "你是一个儿童心理专家，擅长儿童心理健康和发展指导。",
-                "知心大姐姐": "你是一个知心大姐姐，擅长心理疗愈和心理疏导。"
-            }
-            with open(prompts_path, 'w', encoding='utf-8') as f:
-                json.dump(default_prompts, f, indent=4, ensure_ascii=False)
-            return default_prompts
+            return os.stat(self.config['storage']['prompts_path']).st_mtime
+        except OSError:
+            return None
+
+    def _refresh_prompts(self) -> Dict[str, str]:
+        """
+        获取缓存的提示词，仅当提示词文件的mtime变化时才重新加载
+        文件正在编辑导致解析失败时继续使用上一次的提示词
+        """
+        mtime = self._get_prompts_mtime()
+        if mtime is not None and mtime != self._prompts_mtime:
+            try:
+                prompts = self._load_prompts()
+            except (OSError, JSONDecodeError) as e:
+                # 不记录mtime，写入完成后即使mtime相同也会重新加载；同一mtime只警告一次
+                if mtime != self._prompts_failed_mtime:
+                    self._prompts_failed_mtime = mtime
+                    logger.warning("提示词文件读取失败，继续使用已加载的提示词: %s", e)
+                return self._prompts
+            self._prompts = prompts
+            self._prompts_mtime = mtime
+            self._prompts_failed_mtime = None
+            self._system_messages.clear()
+        return self._prompts
+
+    def reload_prompts(self) -> None:
+        """强制重新加载提示词文件"""
+        self._prompts_mtime = None
+        self._refresh_prompts()
+
+    def _get_system_message(self, role: str) -> Dict[str, str]:
+        """
+        获取角色对应的规范system消息
+        同一角色始终返回同一个字符串内容，不向其中注入任何逐轮变化的数据，
+        以便请求前缀在多轮对话中保持逐字节一致
+        """
+        prompts = self._refresh_prompts()
+        message = self._system_messages.get(role)
+        if message is None:
+            message = {"role": "system", "content": prompts.get(role, "")}
+            self._system_messages[role] = message
+        return message
 
     def load_prompt(self, prompt_name: str) -> str:
         """获取特定提示词"""
-        prompts = self._load_prompts()
-        return prompts.get(prompt_name, "")
+        return self._refresh_prompts().get(prompt_name, "")
         
     def update_settings(self, settings: Dict[str, Any]) -> None:
         """更新配置"""
         if 'max_turns' in settings:
-            self.max_turns = settings['max_turns']
+            max_turns = settings['max_turns']
+            if (not isinstance(max_turns, int) or isinstance(max_turns, bool)
+                    or not 1 <= max_turns <= _MAX_TURNS_LIMIT):
+                raise ValueError(f"max_turns must be an integer between 1 and {_MAX_TURNS_LIMIT}")
         if 'truncate_mode' in settings:
             if settings['truncate_mode'] not in ['sliding', 'clear']:
                 raise ValueError("truncate_mode must be 'sliding' or 'clear'")
+        if 'max_turns' in settings:
+            self.max_turns = settings['max_turns']
+        if 'truncate_mode' in settings:
             self.truncate_mode = settings['truncate_mode']
+        if 'max_turns' in settings or 'truncate_mode' in settings:
+            # 按新的轮数上限和截断模式重建历史deque，保留最近的消息
+            maxlen = self._history_maxlen()
+            for user_id, (system_message, history) in self.conversation_context.items():
+                self.conversation_context[user_id] = (
+                    system_message, deque(history, maxlen=maxlen)
+                )
+        if 'max_context_tokens' in settings:
+            self.max_context_tokens = settings['max_context_tokens']
+        if 'max_users' in settings:
+            if settings['max_users'] < 1:
+                raise ValueError("max_users must be greater than 0")
+            self.max_users = settings['max_users']
+            self._evict_contexts()
+        
+        # 更新语义缓存配置
+        cache_settings = {k: settings[k] for k in ['similarity_threshold', 'ttl'] if k in settings}
+        if cache_settings:
+            self.config_loader.update_config({'cache': cache_settings})
+            if self.semantic_cache is not None:
+                if 'similarity_threshold' in cache_settings:
+                    self.semantic_cache.similarity_threshold = cache_settings['similarity_threshold']
+                if 'ttl' in cache_settings:
+                    self.semantic_cache.ttl = cache_settings['ttl']
         
         # 更新OpenAI相关配置
         openai_settings = {k: v for k, v in settings.items() 
-                         if k not in ['max_turns', 'truncate_mode']}
+                         if k not in ['max_turns', 'truncate_mode', 'max_users', 'max_context_tokens',
+                                      'similarity_threshold', 'ttl']}
         if openai_settings:
             self.config_loader.update_config({'openai': openai_settings})
             self.config = self.config_loader.get_config()
+            self._build_request_kwargs()
+            if 'model' in openai_settings:
+                self._token_counter = None  # 模型变化后重新选择tokenizer
     
+    def _conversations_dir(self) -> str:
+        """对话历史目录，每个用户一个JSONL文件"""
+        return os.path.splitext(self.config['storage']['conversations_path'])[0]
+
+    def _conversation_file(self, user_id: str) -> str:
+        """
+        获取用户对话历史文件路径
+        用户ID经百分号编码后作为文件名，编码可逆，不同用户不会映射到同一文件；
+        编码后过长时改用ID的SHA-256摘要，摘要前缀"%s"不会出现在编码结果中，两类文件名不会冲突
+        """
+        safe_id = quote(user_id, safe='')
+        if len(safe_id) > _MAX_FILENAME_ID_LEN:
+            safe_id = "%sha256-" + hashlib.sha256(user_id.encode('utf-8')).hexdigest()
+        return os.path.join(self._conversations_dir(), f"{safe_id}.jsonl")
+
+    def _migrate_legacy_conversations(self) -> None:
+        """将旧版的单一conversations.json一次性拆分为按用户的JSONL文件"""
+        conversations_path = self.config['storage']['conversations_path']
+        conversations_dir = self._conversations_dir()
+        if os.path.isdir(conversations_dir) or not os.path.isfile(conversations_path):
+            return
+        try:
+            with open(conversations_path, 'rb') as f:
+                conversations = json_loads(f.read())
+        except (OSError, JSONDecodeError):
+            logger.exception("迁移对话历史失败")
+            return
+        # 先在临时目录中生成全部文件，再整体重命名，迁移中断时不会留下不完整的目录
+        files: Dict[str, List[bytes]] = {}
+        for user_id, records in conversations.items():
+            filename = os.path.basename(self._conversation_file(user_id))
+            files.setdefault(filename, []).extend(json_dumps(record) + b"\n" for record in records)
+        tmp_dir = f"{conversations_dir}.tmp.{os.getpid()}"
+        os.makedirs(tmp_dir, exist_ok=True)
+        for filename, lines in files.items():
+            write_bytes_atomic(os.path.join(tmp_dir, filename), b"".join(lines))
+        os.replace(tmp_dir, conversations_dir)
+
     '''
-    description: 保存对话历史到JSON文件
+    description: 以追加方式保存对话历史到用户的JSONL文件
     param {*} self
     param {str} user_id 用户ID
-    param {List} conversation ��话历史
+    param {List} conversation 对话历史
     return {*}
     '''    
     def save_conversation(self, user_id: str, conversation: List[Dict]) -> None:
-        """保存对话历史到JSON文件"""
+        """
+        追加保存本轮对话到用户的JSONL文件，写入开销与历史长度无关
+        序列化在当前线程完成，文件写入交给后台线程，调用立即返回
+        """
         # 提取conversation中的后面两个消息
         conversation = conversation[-2:]
-        conversations_path = self.config['storage']['conversations_path']
-        try:
-            os.makedirs(os.path.dirname(conversations_path), exist_ok=True)
-            with open(conversations_path, 'r+', encoding='utf-8') as f:
-                try:
-                    conversations = json.load(f)
-                except json.JSONDecodeError:
-                    conversations = {}
-                
-                conversations[user_id] = conversations.get(user_id, []) + [{
-                    "timestamp": datetime.now().isoformat(),
-                    "messages": conversation
-                }]
-                
-                f.seek(0)
-                json.dump(conversations, f, ensure_ascii=False, indent=2)
-                f.truncate()
-                
-        except FileNotFoundError:
-            with open(conversations_path, 'w', encoding='utf-8') as f:
-                json.dump({user_id: [{
-                    "timestamp": datetime.now().isoformat(),
-                    "messages": conversation
-                }]}, f, ensure_ascii=False, indent=2)
+        line = json_dumps({
+            "timestamp": datetime.now().isoformat(),
+            "messages": conversation
+        }) + b"\n"
+        self._history_writer.write(self._conversation_file(user_id), line)
+
+    def flush_conversations(self) -> None:
+        """等待已保存的对话历史全部写入磁盘"""
+        self._history_writer.flush()
                 
     def get_conversation_history(self, user_id: str) -> List[Dict]:
         """获取用户对话历史"""
-        conversations_path = os.path.join(self.root_dir, 'data', 'conversations.json')
+        # 先写完后台队列中的对话，保证读到最新的历史
+        self.flush_conversations()
+        history = []
         try:
-            with open(conversations_path, 'r', encoding='utf-8') as f:
-                conversations = json.load(f)
-                return conversations.get(user_id, [])
+            with open(self._conversation_file(user_id), 'rb') as f:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_SH)
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        history.append(json_loads(line))
+                    except JSONDecodeError:
+                        continue  # 跳过写入中断产生的不完整行
         except FileNotFoundError:
-            return [] 
+            return []
+        return history
 
     def set_role(self, role_type: str) -> bool:
         """
@@ -231,8 +571,8 @@ class OpenAIAssistant(LLMBase):
                 self.current_role = role_type
                 return True
             return False
-        except Exception as e:
-            print(f"设置角色失败: {str(e)}")
+        except Exception:
+            logger.exception("设置角色失败")
             return False
 
     def get_current_role(self) -> str:
@@ -241,29 +581,41 @@ class OpenAIAssistant(LLMBase):
 
     def list_available_roles(self) -> List[str]:
         """获取所有可用的角色类型"""
-        try:
-            prompts = self._load_prompts()
-            return list(prompts.keys())
-        except Exception:
-            return ["default"]  # 如果加载失败，至少返回默认角色
+        roles = list(self._refresh_prompts().keys())
+        return roles or ["default"]  # 如果没有加载到提示词，至少返回默认角色
+
+    def _evict_contexts(self) -> None:
+        """淘汰最久未使用的用户上下文，使驻留用户数不超过max_users"""
+        while len(self.conversation_context) > self.max_users:
+            user_id, _ = self.conversation_context.popitem(last=False)
+            self._last_message_times.pop(user_id, None)
+            self._prefetched.pop(user_id, None)
 
     def clear_context(self, user_id: str) -> None:
         """清除指定用户的对话上下文"""
         if user_id in self.conversation_context:
             del self.conversation_context[user_id]
+        self._last_message_times.pop(user_id, None)
+        self._prefetched.pop(user_id, None)
 
     def get_current_context(self, user_id: str) -> Optional[List[Dict]]:
         """获取指定用户的当前对话上下文"""
-        return self.conversation_context.get(user_id)
+        context = self.conversation_context.get(user_id)
+        if context is None:
+            return None
+        system_message, history = context
+        return [system_message, *history]
 
     def clear_all_contexts(self) -> None:
         """清除所有用户的对话上下文"""
         self.conversation_context.clear()
+        self._last_message_times.clear()
+        self._prefetched.clear()
 
     def get_context_summary(self, user_id: str) -> Dict[str, Any]:
         """获取用户对话上下文的摘要信息"""
         context = self.conversation_context.get(user_id)
-        if not context:
+        if context is None:
             return {
                 "message_count": 0,
                 "has_context": False,
@@ -271,41 +623,215 @@ class OpenAIAssistant(LLMBase):
                 "current_turns": 0
             }
         
-        current_turns = (len(context) - 1) // 2  # 不计算system消息
+        history = context[1]
+        current_turns = len(history) // 2  # 每轮包含一个user消息和一个assistant消息
         
         return {
-            "message_count": len(context) - 1,
+            "message_count": len(history),
             "has_context": True,
             "current_role": self.current_role,
-            "last_message_time": datetime.now().isoformat(),
+            "last_message_time": self._format_last_message_time(user_id),
             "max_turns": self.max_turns,
             "current_turns": current_turns
         }
 
-    def _truncate_context(self, context: List[Dict]) -> List[Dict]:
+    def _prepare_context(self, user_id: str, message: str) -> Tuple[List[Dict], Deque[Dict]]:
         """
-        截断对话上下文
+        准备本轮请求的上下文
+        获取当前角色的system消息，获取或初始化用户的历史消息，并按token预算截断
+        clear模式下历史超过max_turns轮时，先清空历史再开始本轮
         Args:
-            context: 当前上下文
+            user_id: 用户ID
+            message: 用户消息
         Returns:
-            截断后的上下文
+            (发送给API的消息列表, 用户的历史消息)，消息列表的最后一条为本轮用户消息
         """
-        if len(context) <= 1:  # 只有system消息
-            return context
-            
-        # 计算实际对话轮数（不包括system消息）
-        turns = (len(context) - 1) // 2  # 每轮包含一个user消息和一个assistant消息
+        system_message = self._get_system_message(self.current_role)
+        history = self._get_history(user_id, system_message)
+        if self.truncate_mode == 'clear' and len(history) > self.max_turns * 2:
+            history.clear()
+        user_message = {"role": "user", "content": message}
+        return self._truncate_context(system_message, history, user_message), history
+
+    def _history_maxlen(self) -> int:
+        """
+        历史deque的最大长度(每轮2条消息)
+        clear模式与原实现一致：历史超过max_turns轮才清空，因此需要多容纳一轮
+        """
+        if self.truncate_mode == 'clear':
+            return self.max_turns * 2 + 2
+        return self.max_turns * 2
+
+    def _get_history(self, user_id: str, system_message: Dict[str, str]) -> Deque[Dict]:
+        """
+        获取或初始化用户的历史消息
+        仅在角色(提示词)确实改变时才替换system消息，保持请求前缀不变
+        """
+        context = self.conversation_context.get(user_id)
+        if context is None:
+            history = deque(maxlen=self._history_maxlen())
+            self.conversation_context[user_id] = (system_message, history)
+            self._evict_contexts()
+            return history
         
-        if turns <= self.max_turns:
-            return context
+        self.conversation_context.move_to_end(user_id)
+        current_system, history = context
+        if current_system["content"] != system_message["content"]:
+            self.conversation_context[user_id] = (system_message, history)
+        return history
+
+    def _get_token_counter(self):
+        """
+        获取带缓存的token计数函数
+        模型不被tiktoken识别时使用cl100k_base近似计数；未安装tiktoken时返回None
+        """
+        if self._token_counter is None:
+            try:
+                import tiktoken
+            except ImportError:
+                return None
+            try:
+                encoding = tiktoken.encoding_for_model(self.config['openai']['model'])
+            except KeyError:
+                encoding = tiktoken.get_encoding('cl100k_base')
+            self._token_counter = functools.lru_cache(maxsize=4096)(
+                lambda content: len(encoding.encode(content))
+            )
+        return self._token_counter
+
+    def _format_last_message_time(self, user_id: str) -> Optional[str]:
+        """格式化用户最后一轮对话的时间，尚无对话时返回None"""
+        timestamp = self._last_message_times.get(user_id)
+        if timestamp is None:
+            return None
+        return datetime.fromtimestamp(timestamp).isoformat()
+
+    def _truncate_context(self, system_message: Dict[str, str], history: Deque[Dict],
+                          user_message: Dict[str, str]) -> List[Dict]:
+        """
+        构造请求消息，并按token预算截断历史
+        从最新的一轮向前累加token数，超出 max_context_tokens - max_tokens - 预留量 的更早对话
+        直接从历史中移除(clear模式下清空历史)，不额外复制历史列表
+        Args:
+            system_message: system消息
+            history: 历史消息
+            user_message: 本轮用户消息
+        Returns:
+            发送给API的消息列表
+        """
+        count = self._get_token_counter() if self.max_context_tokens else None
+        if count is not None:
+            budget = (self.max_context_tokens
+                      - self._request_kwargs['max_tokens']
+                      - _TOKEN_SAFETY_MARGIN)
+            used = (count(system_message["content"]) + count(user_message["content"])
+                    + 2 * _TOKENS_PER_MESSAGE)
+            # 以轮(user+assistant)为单位向前累加，保证user/assistant消息成对保留
+            start = len(history)
+            while start >= 2:
+                turn_tokens = (count(history[start - 2]["content"]) + count(history[start - 1]["content"])
+                               + 2 * _TOKENS_PER_MESSAGE)
+                if used + turn_tokens > budget:
+                    break
+                used += turn_tokens
+                start -= 2
             
-        if self.truncate_mode == 'clear':
-            # 保留system消息，清除其他所有消息
-            return [context[0]]
-        else:  # sliding mode
-            # 保留system消息和最近的max_turns轮对话
-            preserved_messages_count = self.max_turns * 2  # 每轮2条消息
-            return [context[0]] + context[-preserved_messages_count:]
+            if start:
+                if self.truncate_mode == 'clear':
+                    history.clear()
+                else:  # sliding mode
+                    for _ in range(start):
+                        history.popleft()
+        
+        return [system_message, *history, user_message]
+
+    def _append_turn(self, user_id: str, history: Deque[Dict], turn: List[Dict]) -> None:
+        """
+        将一轮对话(user消息和assistant消息)追加到历史，并记录最后消息时间
+        sliding模式下deque达到maxlen时自动淘汰最早的一轮；
+        clear模式的清空在下一轮请求前由_prepare_context完成，本轮对话始终保留
+        上下文变化后预取的回复已经过时，无论本轮来自哪个入口都丢弃预取槽
+        请求期间用户可能已被LRU淘汰(并发的achat中很常见)，此时不再记录时间，
+        避免_last_message_times随淘汰的用户无限增长
+        """
+        self._prefetched.pop(user_id, None)
+        history.extend(turn)
+        if user_id in self.conversation_context:
+            self._last_message_times[user_id] = time.time()
+
+    def _check_role(self, role_type: Optional[str]) -> Optional[str]:
+        """按需切换到指定角色，角色无效时返回错误信息"""
+        if role_type and role_type != self.current_role:
+            if not self.set_role(role_type):
+                return f"无效的角色类型: {role_type}"
+        return None
+
+    def _error_result(self, error: str) -> Dict[str, Any]:
+        """chat/achat的错误返回值"""
+        return {
+            "error": error,
+            "timestamp": datetime.now().isoformat(),
+            "current_role": self.current_role
+        }
+
+    def _chat_result(self, reply: str) -> Dict[str, Any]:
+        """chat/achat的成功返回值"""
+        return {
+            "response": reply,
+            "timestamp": datetime.now().isoformat(),
+            "current_role": self.current_role
+        }
+
+    def _begin_cache_lookup(self, user_id: str, message: str,
+                            history: Deque[Dict]) -> Tuple[Optional[str], Optional[str]]:
+        """
+        取出预取的回复；未预取且启用了语义缓存时返回需要计算embedding的查询文本
+        Returns:
+            (预取的回复, 语义缓存的查询文本)，两者至多一个不为None
+        """
+        reply = self._take_prefetched(user_id, message)
+        if reply is None and self.semantic_cache is not None:
+            return None, self._cache_query_text(history, message)
+        return reply, None
+
+    def _lookup_cached(self, embedding: Optional[List[float]]) -> Optional[str]:
+        """用查询文本的embedding查找语义缓存"""
+        if embedding is None:
+            return None
+        return self.semantic_cache.lookup(embedding, self.current_role)
+
+    def _record_turn(self, user_id: str, history: Deque[Dict], user_message: Dict[str, str],
+                     reply: str, embedding: Optional[List[float]] = None) -> None:
+        """
+        一轮对话完成后的收尾：写入语义缓存(提供了embedding时)、追加到上下文并保存对话历史
+        """
+        if embedding is not None:
+            self.semantic_cache.add(embedding, reply, self.current_role)
+        turn = [user_message, {"role": "assistant", "content": reply}]
+        self._append_turn(user_id, history, turn)
+        self.save_conversation(user_id, turn)
+
+    def _stream_event(self, kind: int, payload: Optional[str], timestamp: Optional[str]) -> Dict[str, Any]:
+        """将 (kind, payload) 元组转换为chat_stream产出的字典，content片段使用流开始的时间戳"""
+        if kind == STREAM_CONTENT:
+            return {
+                "content": payload,
+                "type": "content",
+                "timestamp": timestamp,
+                "current_role": self.current_role
+            }
+        if kind == STREAM_DONE:
+            return {
+                "type": "done",
+                "timestamp": datetime.now().isoformat(),
+                "current_role": self.current_role
+            }
+        return {
+            "error": payload,
+            "type": "error",
+            "timestamp": datetime.now().isoformat(),
+            "current_role": self.current_role
+        }
 
     def chat_stream(self, user_id: str, message: str, role_type: Optional[str] = None):
         """
@@ -317,82 +843,150 @@ class OpenAIAssistant(LLMBase):
         Yields:
             生成的文本片段
         """
+        timestamp = None
+        for kind, payload in self.chat_stream_raw(user_id, message, role_type):
+            if timestamp is None:
+                # 时间戳在流开始时计算一次，避免在逐chunk循环中重复取时间和格式化
+                timestamp = datetime.now().isoformat()
+            yield self._stream_event(kind, payload, timestamp)
+
+    def chat_stream_raw(self, user_id: str, message: str, role_type: Optional[str] = None):
+        """
+        流式处理用户消息，产出轻量的 (kind, payload) 元组
+        kind为STREAM_CONTENT/STREAM_DONE/STREAM_ERROR之一，省去每个片段的字典构造与查找
+        Args:
+            user_id: 用户ID
+            message: 用户消息
+            role_type: 指定的角色类型，如果为None则使用当前角色
+        Yields:
+            (kind, payload) 元组
+        """
         try:
-            # 如果指定了新的角色类型，就更新当前角色
-            if role_type and role_type != self.current_role:
-                if not self.set_role(role_type):
-                    yield {
-                        "error": f"无效的角色类型: {role_type}",
-                        "timestamp": datetime.now().isoformat()
-                    }
-                    return
-
-            # 获取当前角色的提示词
-            system_prompt = self.load_prompt(self.current_role)
-            
-            # 获取或初始化用户的上下文
-            if user_id not in self.conversation_context:
-                self.conversation_context[user_id] = [{"role": "system", "content": system_prompt}]
-            else:
-                if self.conversation_context[user_id][0]["role"] == "system":
-                    self.conversation_context[user_id][0]["content"] = system_prompt
-                else:
-                    self.conversation_context[user_id].insert(0, {"role": "system", "content": system_prompt})
-            
-            # 在添加新消息前检查并截断上下文
-            if user_id in self.conversation_context:
-                self.conversation_context[user_id] = self._truncate_context(
-                    self.conversation_context[user_id]
-                )
-            
-            # 添加用户消息
-            self.conversation_context[user_id].append({"role": "user", "content": message})
+            error = self._check_role(role_type)
+            if error is not None:
+                yield STREAM_ERROR, error
+                return
+
+            messages, history = self._prepare_context(user_id, message)
             
             # 创建流式请求
             stream = self.client.chat.completions.create(
-                model=self.config['openai']['model'],
-                messages=self.conversation_context[user_id],
-                temperature=self.config['openai'].get('temperature', 0.7),
-                max_tokens=self.config['openai'].get('max_tokens', 1000),
-                top_p=self.config['openai'].get('top_p', 1.0),
-                stream=True  # 启用流式传输
+                messages=messages,
+                stream=True,  # 启用流式传输
+                **self._request_kwargs
             )
 
-            # 用于累积完整的响应
-            full_response = ""
-            
-            # 逐个产出流式响应
+            batcher = _ChunkBatcher()
             for chunk in stream:
-                if chunk.choices[0].delta.content is not None:
-                    content = chunk.choices[0].delta.content
-                    full_response += content
-                    yield {
-                        "content": content,
-                        "type": "content",
-                        "timestamp": datetime.now().isoformat(),
-                        "current_role": self.current_role
-                    }
-
-            # 保存完整的对话到上下文
-            self.conversation_context[user_id].append(
-                {"role": "assistant", "content": full_response}
-            )
+                content = chunk.choices[0].delta.content
+                if content is not None:
+                    batch = batcher.feed(content)
+                    if batch is not None:
+                        yield STREAM_CONTENT, batch
+            batch = batcher.drain()
+            if batch is not None:
+                yield STREAM_CONTENT, batch
+
+            reply = batcher.text()
+            self._record_turn(user_id, history, messages[-1], reply)
+            yield STREAM_DONE, reply
             
-            # 保存对话历史
-            self.save_conversation(user_id, self.conversation_context[user_id])
+        except Exception as e:
+            logger.exception("Stream chat error")
+            yield STREAM_ERROR, str(e)
+
+    async def achat(self, user_id: str, message: str, role_type: Optional[str] = None) -> Dict[str, Any]:
+        """
+        异步处理用户消息，与chat行为一致
+        对话历史在后台线程中保存，不阻塞回复返回
+        Args:
+            user_id: 用户ID
+            message: 用户消息
+            role_type: 指定的角色类型，如果为None则使用当前角色
+        """
+        try:
+            error = self._check_role(role_type)
+            if error is not None:
+                return self._error_result(error)
+
+            messages, history = self._prepare_context(user_id, message)
             
-            # 发送完成标记
-            yield {
-                "type": "done",
-                "timestamp": datetime.now().isoformat(),
-                "current_role": self.current_role
-            }
+            reply, query = self._begin_cache_lookup(user_id, message, history)
+            embedding = None
+            if query is not None:
+                embedding = await self._aembed(query)
+                reply = self._lookup_cached(embedding)
+            if reply is not None:
+                self._record_turn(user_id, history, messages[-1], reply)
+                return self._chat_result(reply)
+            
+            response = await self._amake_request(messages)
+            if not response["success"]:
+                return self._error_result(response["error"])
+            
+            reply = response["data"].choices[0].message.content
+            self._record_turn(user_id, history, messages[-1], reply, embedding)
+            return self._chat_result(reply)
             
         except Exception as e:
-            print(f"Stream chat error: {str(e)}")
-            yield {
-                "error": str(e),
-                "type": "error",
-                "timestamp": datetime.now().isoformat(),
-                "current_role": self.current_role
-            }
\ No newline at end of file
+            logger.exception("Chat error")
+            return self._error_result(str(e))
+
+    async def achat_stream(self, user_id: str, message: str, role_type: Optional[str] = None):
+        """
+        异步流式处理用户消息，产出格式与chat_stream一致
+        Args:
+            user_id: 用户ID
+            message: 用户消息
+            role_type: 指定的角色类型，如果为None则使用当前角色
+        Yields:
+            生成的文本片段
+        """
+        timestamp = None
+        async for kind, payload in self.achat_stream_raw(user_id, message, role_type):
+            if timestamp is None:
+                timestamp = datetime.now().isoformat()
+            yield self._stream_event(kind, payload, timestamp)
+
+    async def achat_stream_raw(self, user_id: str, message: str, role_type: Optional[str] = None):
+        """
+        异步流式处理用户消息，产出格式与chat_stream_raw一致
+        Args:
+            user_id: 用户ID
+            message: 用户消息
+            role_type: 指定的角色类型，如果为None则使用当前角色
+        Yields:
+            (kind, payload) 元组
+        """
+        try:
+            error = self._check_role(role_type)
+            if error is not None:
+                yield STREAM_ERROR, error
+                return
+
+            messages, history = self._prepare_context(user_id, message)
+            
+            stream = await self.aclient.chat.completions.create(
+                messages=messages,
+                stream=True,
+                **self._request_kwargs
+            )
+
+            batcher = _ChunkBatcher()
+            async for chunk in stream:
+                content = chunk.choices[0].delta.content
+                if content is not None:
+                    batch = batcher.feed(content)
+                    if batch is not None:
+                        yield STREAM_CONTENT, batch
+            batch = batcher.drain()
+            if batch is not None:
+                yield STREAM_CONTENT, batch
+
+            reply = batcher.text()
+            self._record_turn(user_id, history, messages[-1], reply)
+            yield STREAM_DONE, reply
+            
+        except Exception as e:
+            logger.exception("Stream chat error")
+            yield STREAM_ERROR, str(e)
@@ -1,35 +1,29 @@
-from abc import ABC, abstractmethod
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Protocol, runtime_checkable
 
-class LLMBase(ABC):
-    """LLM基类，定义统一接口"""
+@runtime_checkable
+class LLMBase(Protocol):
+    """LLM接口协议，定义统一接口（结构化类型，实现类无需继承）"""
     
-    @abstractmethod
     def initialize(self) -> None:
         """初始化LLM客户端"""
-        pass
+        ...
     
-    @abstractmethod
     def chat(self, user_id: str, message: str, context: Optional[List[Dict]] = None) -> Dict[str, Any]:
         """聊天接口"""
-        pass
+        ...
     
-    @abstractmethod
     def update_settings(self, settings: Dict[str, Any]) -> None:
         """更新设置"""
-        pass
+        ...
     
-    @abstractmethod
     def load_prompt(self, prompt_name: str) -> str:
         """加载提示词"""
-        pass
+        ...
     
-    @abstractmethod
     def save_conversation(self, user_id: str, conversation: List[Dict]) -> None:
         """保存对话历史"""
-        pass
+        ...
     
-    @abstractmethod
     def get_conversation_history(self, user_id: str) -> List[Dict]:
         """获取对话历史"""
-        pass 
\ No newline at end of file
+        ...
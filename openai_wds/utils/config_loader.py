@@ -5,10 +5,22 @@ Description:
 邮箱：wdsnpshy@163.com 
 Copyright (c) 2024 by ${wds-Ubuntu22-cqu}, All Rights Reserved. 
 '''
+import copy
 import os
-import json
-from typing import Dict, Any
-from dotenv import load_dotenv
+from pathlib import Path
+from typing import Dict, Any, Tuple
+from .json_utils import json_loads
+
+# 进程内的配置缓存，键为(配置文件路径, 修改时间)，配置文件未变化时跳过读盘和解析
+_CONFIG_CACHE: Dict[Tuple[str, float], Dict[str, Any]] = {}
+
+def _deep_merge(dst: Dict[str, Any], src: Dict[str, Any]) -> None:
+    """将src递归合并到dst中，只替换src中出现的叶子值"""
+    for key, value in src.items():
+        if isinstance(value, dict) and isinstance(dst.get(key), dict):
+            _deep_merge(dst[key], value)
+        else:
+            dst[key] = value
 
 class ConfigLoader:
     def __init__(self, config_path: str):
@@ -18,16 +30,35 @@ class ConfigLoader:
             config_path: 配置文件的完整路径
         """
         self.config_path = config_path
-        load_dotenv()
         self.config = self._load_config()
         
     def _load_config(self) -> Dict[str, Any]:
-        """加载并验证配置文件"""
-        if not os.path.exists(self.config_path):
+        """加载并验证配置文件，相同路径且未修改的配置文件直接使用缓存"""
+        try:
+            mtime = os.stat(self.config_path).st_mtime
+        except FileNotFoundError:
             raise FileNotFoundError(f"Configuration file not found: {self.config_path}")
-            
-        with open(self.config_path, 'r', encoding='utf-8') as f:
-            config = json.load(f)
+        
+        key = (self.config_path, mtime)
+        cached = _CONFIG_CACHE.get(key)
+        if cached is None:
+            cached = self._parse_config()
+            # 配置文件已修改，丢弃该路径的旧缓存
+            for old_key in [k for k in _CONFIG_CACHE if k[0] == self.config_path]:
+                del _CONFIG_CACHE[old_key]
+            _CONFIG_CACHE[key] = cached
+        
+        # 返回副本，避免update_config修改缓存内容
+        config = copy.deepcopy(cached)
+        
+        # 替换环境变量
+        config['openai']['api_key'] = os.getenv('OPENAI_API_KEY')
+        return config
+    
+    def _parse_config(self) -> Dict[str, Any]:
+        """读取、验证配置文件并规范化存储路径"""
+        with open(self.config_path, 'rb') as f:
+            config = json_loads(f.read())
             
         # 验证必要的配置项
         required_keys = ['openai', 'storage', 'conversation']
@@ -35,16 +66,15 @@ class ConfigLoader:
             if key not in config:
                 raise KeyError(f"Missing required configuration key: {key}")
         
-        # 替换环境变量
-        config['openai']['api_key'] = os.getenv('OPENAI_API_KEY')
-        
         # 确保存储路径是相对于配置文件的路径
-        config_dir = os.path.dirname(self.config_path)
-        for path_key in ['conversations_path', 'prompts_path']:
-            if not os.path.isabs(config['storage'][path_key]):
-                config['storage'][path_key] = os.path.normpath(
-                    os.path.join(config_dir, config['storage'][path_key])
-                )
+        storage = config['storage']
+        config_dir = Path(self.config_path).parent
+        for path_key in ['conversations_path', 'prompts_path', 'semantic_cache_path']:
+            if path_key not in storage:
+                continue
+            path = Path(storage[path_key])
+            if not path.is_absolute():
+                storage[path_key] = str((config_dir / path).resolve(strict=False))
                 
         return config
     
@@ -53,7 +83,6 @@ class ConfigLoader:
         return self.config
     
     def update_config(self, updates: Dict[str, Any]) -> None:
-        """更新配置"""
+        """更新配置，嵌套的字典逐层合并，不存在的配置节会被创建"""
         for key, value in updates.items():
-            if key in self.config:
-                self.config[key].update(value) 
\ No newline at end of file
+            _deep_merge(self.config.setdefault(key, {}), value) 
\ No newline at end of file
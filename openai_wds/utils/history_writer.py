@@ -0,0 +1,89 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import fcntl  # 仅POSIX系统可用，用于多进程写入对话历史时加锁
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryWriter:
+    """
+    在后台线程中追加写入对话历史文件
+    写入请求放入队列后立即返回；后台线程每次取出队列中的全部请求，
+    按文件合并后每个文件只打开、加锁、写入一次
+    """
+
+    def __init__(self):
+        self._queue: "queue.Queue[Tuple[str, bytes]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+
+    def write(self, path: str, data: bytes) -> None:
+        """将要追加到path的数据放入写入队列"""
+        if self._thread is None:
+            self._start()
+        self._queue.put((path, data))
+
+    def flush(self) -> None:
+        """阻塞直到队列中已有的写入全部完成"""
+        if self._thread is not None:
+            self._queue.join()
+
+    def _start(self) -> None:
+        """启动后台写入线程，并在解释器退出前写完剩余数据"""
+        with self._start_lock:
+            if self._thread is None:
+                thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+                thread.start()
+                atexit.register(self.flush)
+                self._thread = thread
+
+    def _run(self) -> None:
+        while True:
+            items = [self._queue.get()]
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write_batch(items)
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+
+    @staticmethod
+    def _write_batch(items: List[Tuple[str, bytes]]) -> None:
+        """按文件合并一批写入请求，单个文件写入失败不影响其他文件"""
+        batches: Dict[str, List[bytes]] = {}
+        for path, data in items:
+            batches.setdefault(path, []).append(data)
+        for path, chunks in batches.items():
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'ab') as f:
+                    if fcntl is not None:
+                        fcntl.flock(f, fcntl.LOCK_EX)
+                    try:
+                        f.write(b"".join(chunks))
+                        f.flush()
+                    finally:
+                        if fcntl is not None:
+                            fcntl.flock(f, fcntl.LOCK_UN)
+            except OSError:
+                logger.exception("写入对话历史失败: %s", path)
+
+
+_HISTORY_WRITER = HistoryWriter()
+
+
+def get_history_writer() -> HistoryWriter:
+    """获取进程内共享的对话历史写入器，所有助手实例共用一个后台线程"""
+    return _HISTORY_WRITER
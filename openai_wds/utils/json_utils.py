@@ -0,0 +1,57 @@
+import json
+import os
+from typing import Any, Union
+
+try:
+    import orjson  # C实现的JSON库，优先使用
+except ImportError:
+    orjson = None
+
+# orjson.JSONDecodeError 是 json.JSONDecodeError 的子类，两种实现可统一捕获
+JSONDecodeError = json.JSONDecodeError
+
+
+def json_loads(data: Union[bytes, str]) -> Any:
+    """解析JSON，可直接接受二进制读取的字节内容"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj: Any, indent: bool = False) -> bytes:
+    """
+    序列化为UTF-8编码的JSON字节串
+    Args:
+        obj: 待序列化的对象
+        indent: 是否使用两个空格缩进
+    """
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option)
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None).encode('utf-8')
+
+
+def write_bytes_atomic(path: str, data: bytes) -> None:
+    """
+    原子地写入文件
+    先写入同目录下的临时文件并fsync，再用os.replace替换目标文件，
+    写入中途崩溃也不会留下不完整的内容
+    """
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def dump_json_atomic(path: str, obj: Any, indent: bool = False) -> None:
+    """原子地将对象写入JSON文件"""
+    write_bytes_atomic(path, json_dumps(obj, indent=indent))
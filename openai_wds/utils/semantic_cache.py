@@ -0,0 +1,185 @@
+import atexit
+import io
+import os
+import time
+from typing import Dict, Any, List, Optional, Sequence
+from .json_utils import json_loads, dump_json_atomic, write_bytes_atomic
+
+
+class SemanticCache:
+    """
+    基于向量相似度的响应缓存
+    将查询文本的归一化embedding保存为float32矩阵，查询时通过一次矩阵向量乘法
+    计算余弦相似度，超过阈值即返回缓存的回复
+    矩阵按容量倍增预分配，添加条目均摊为O(1)；条目数达到上限时清理过期条目并淘汰最旧的条目
+    """
+
+    def __init__(self, path: Optional[str] = None, similarity_threshold: float = 0.92,
+                 ttl: Optional[float] = None, max_entries: int = 10000, save_interval: int = 32):
+        """
+        初始化语义缓存
+        Args:
+            path: 持久化路径前缀，会生成 path.npy 与 path.json 两个文件；为None时仅保存在内存
+            similarity_threshold: 命中所需的最小余弦相似度
+            ttl: 缓存条目的有效期(秒)，为None时永不过期
+            max_entries: 最多保存的条目数
+            save_interval: 每新增多少条目持久化一次，进程退出时会保存剩余的修改
+        """
+        import numpy as np  # 可选依赖，仅在启用语义缓存时导入
+        self._np = np
+        self.path = path
+        self.similarity_threshold = similarity_threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.save_interval = save_interval
+        # 预分配的矩阵，只有前_size行有效
+        self._matrix = np.empty((0, 0), dtype=np.float32)
+        self._size = 0
+        self._entries: List[Dict[str, Any]] = []
+        self._unsaved = 0
+        self._load()
+        if self.path:
+            atexit.register(self._save_if_dirty)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _normalize(self, embedding: Sequence[float]):
+        """将embedding转换为单位长度的float32向量"""
+        vector = self._np.asarray(embedding, dtype=self._np.float32)
+        norm = self._np.linalg.norm(vector)
+        if norm > 0:
+            vector = vector / norm
+        return vector
+
+    def lookup(self, embedding: Sequence[float], namespace: str = "",
+               threshold: Optional[float] = None) -> Optional[str]:
+        """
+        查找与embedding最相似且未过期的缓存回复
+        Args:
+            embedding: 查询文本的embedding
+            namespace: 缓存分区(例如角色名)，只在同一分区内匹配
+            threshold: 覆盖默认的相似度阈值
+        Returns:
+            命中时返回缓存的回复，否则返回None
+        """
+        if not self._size:
+            return None
+        query = self._normalize(embedding)
+        if query.shape[0] != self._matrix.shape[1]:
+            return None
+
+        if threshold is None:
+            threshold = self.similarity_threshold
+        scores = self._matrix[:self._size] @ query
+        candidates = self._np.flatnonzero(scores >= threshold)
+        if candidates.size == 0:
+            return None
+
+        now = time.time()
+        for index in candidates[self._np.argsort(-scores[candidates])]:
+            entry = self._entries[index]
+            if entry["namespace"] != namespace:
+                continue
+            if self.ttl is not None and now - entry["created"] > self.ttl:
+                continue
+            return entry["response"]
+        return None
+
+    def add(self, embedding: Sequence[float], response: str, namespace: str = "") -> None:
+        """添加一条缓存，每save_interval条持久化一次"""
+        vector = self._normalize(embedding)
+        if self._size and vector.shape[0] != self._matrix.shape[1]:
+            # embedding维度变化(例如更换了模型)，旧缓存已无法比较
+            self.clear()
+        if self._size >= self.max_entries:
+            self._compact()
+        if self._size >= self._matrix.shape[0] or vector.shape[0] != self._matrix.shape[1]:
+            self._grow(vector.shape[0])
+        self._matrix[self._size] = vector
+        self._size += 1
+        self._entries.append({
+            "namespace": namespace,
+            "response": response,
+            "created": time.time()
+        })
+        self._unsaved += 1
+        if self._unsaved >= self.save_interval:
+            self.save()
+
+    def _grow(self, dim: int) -> None:
+        """容量翻倍(不超过max_entries)，只复制有效行"""
+        capacity = min(max(2 * self._matrix.shape[0], 16), self.max_entries)
+        matrix = self._np.empty((capacity, dim), dtype=self._np.float32)
+        if self._size:
+            matrix[:self._size] = self._matrix[:self._size]
+        self._matrix = matrix
+
+    def _unexpired(self) -> List[int]:
+        """未过期条目的下标(按添加时间顺序)"""
+        if self.ttl is None:
+            return list(range(self._size))
+        now = time.time()
+        return [i for i in range(self._size) if now - self._entries[i]["created"] <= self.ttl]
+
+    def _compact(self) -> None:
+        """清理过期条目；仍然已满时淘汰最旧的四分之一，使淘汰开销均摊到多次添加"""
+        keep = self._unexpired()
+        if len(keep) >= self.max_entries:
+            keep = keep[len(keep) - self.max_entries * 3 // 4:]
+        self._keep(keep)
+
+    def _keep(self, indices: List[int]) -> None:
+        """只保留给定下标(按时间顺序)的条目"""
+        if len(indices) == self._size:
+            return
+        count = len(indices)
+        if count:
+            self._matrix[:count] = self._matrix[indices]
+        self._entries = [self._entries[i] for i in indices]
+        self._size = count
+        self._unsaved += 1
+
+    def clear(self) -> None:
+        """清空缓存"""
+        self._matrix = self._np.empty((0, 0), dtype=self._np.float32)
+        self._size = 0
+        self._entries = []
+        self._unsaved += 1
+
+    def save(self) -> None:
+        """将缓存矩阵与条目信息原子地保存到磁盘"""
+        self._unsaved = 0
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        buffer = io.BytesIO()
+        self._np.save(buffer, self._matrix[:self._size])
+        write_bytes_atomic(self.path + '.npy', buffer.getvalue())
+        dump_json_atomic(self.path + '.json', self._entries)
+
+    def _save_if_dirty(self) -> None:
+        """进程退出时保存尚未持久化的修改"""
+        if self._unsaved:
+            self.save()
+
+    def _load(self) -> None:
+        """从磁盘加载缓存并清理过期条目，文件缺失或不一致时从空缓存开始"""
+        if not self.path:
+            return
+        try:
+            matrix = self._np.load(self.path + '.npy')
+            with open(self.path + '.json', 'rb') as f:
+                entries = json_loads(f.read())
+        except (OSError, ValueError):
+            return
+        if matrix.ndim != 2 or matrix.shape[0] != len(entries):
+            return
+        self._matrix = matrix.astype(self._np.float32, copy=False)
+        self._size = len(entries)
+        self._entries = entries
+        self._unsaved = 0
+        # 丢弃过期条目，并只保留最新的max_entries条
+        self._keep(self._unexpired()[-self.max_entries:])